@@ -6,10 +6,14 @@ def main():
     parser.add_argument("query", type=str, help="PubMed search query.")
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode.")
     parser.add_argument("-f", "--file", type=str, help="Save results to a CSV file.")
+    parser.add_argument("-n", "--max-results", type=int, default=10, help="Maximum number of papers to fetch.")
+    parser.add_argument("-c", "--cache", action="store_true", help="Cache API responses on disk.")
+    parser.add_argument("-k", "--api-key", type=str, help="NCBI API key (defaults to the NCBI_API_KEY environment variable).")
 
     args = parser.parse_args()
 
-    fetcher = PubMedFetcher(query=args.query, debug=args.debug)
+    fetcher = PubMedFetcher(query=args.query, debug=args.debug, max_results=args.max_results,
+                            use_cache=args.cache, api_key=args.api_key)
     papers = fetcher.fetch_papers()
     fetcher.save_to_csv(papers, filename=args.file)
 
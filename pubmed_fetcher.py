@@ -1,8 +1,184 @@
-import requests
 import csv
-from typing import List, Dict, Optional
-from lxml import etree
+import os
+import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from typing import Iterator, List, Dict, Optional, Tuple
+
+import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional; fall back to the standard library
+    from json import loads as json_loads
+
+try:
+    import requests_cache
+except ImportError:  # requests-cache is optional; responses are not cached without it
+    requests_cache = None
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick is optional; fall back to the regex matcher
+    ahocorasick = None
+
+_CACHE_NAME = "pubmed_cache"  # SQLite file used by the on-disk HTTP cache
+# esearch returns a WebEnv that expires on NCBI's history server, and efetch pages are keyed by it,
+# so both are only reused briefly, from the on-disk cache and from the in-process memo
+_WEBENV_EXPIRE_AFTER = 15 * 60
+
+# In-process memo of recent esearch results, least recently used first
+_ESEARCH_MEMO_SIZE = 128
+_esearch_memo = OrderedDict()
+_esearch_memo_lock = threading.Lock()
+
+# Minimum spacing between E-utilities request launches; NCBI allows 3 requests/second without an API key
+_REQUEST_INTERVAL = 1 / 3
+_REQUEST_INTERVAL_WITH_API_KEY = 1 / 10  # ...and 10 requests/second with one
+_request_lock = threading.Lock()
+_next_request_at = 0.0
+
+# Keywords to filter affiliations, compiled once into a single case-insensitive pattern
+_KEYWORDS = ("pharma", "biotech", "pharmaceutical", "biotechnology")
+_AFFIL_RE = re.compile("|".join(re.escape(keyword) for keyword in _KEYWORDS), re.IGNORECASE)
+
+# Aho-Corasick automaton over the same keywords, when pyahocorasick is installed
+_AFFIL_AUTOMATON = None
+if ahocorasick is not None:
+    _AFFIL_AUTOMATON = ahocorasick.Automaton()
+    for _keyword in _KEYWORDS:
+        _AFFIL_AUTOMATON.add_word(_keyword, _keyword)
+    _AFFIL_AUTOMATON.make_automaton()
+
+# libxml2 options that skip work this parser does not need (ID tables, blank text nodes, entity expansion)
+_PARSER_OPTIONS = {
+    "collect_ids": False,
+    "remove_blank_text": True,
+    "resolve_entities": False,
+    "huge_tree": False,
+}
+
+# Top-level records in an efetch response; Bookshelf records come as PubmedBookArticle
+_ARTICLE_TAGS = ("PubmedArticle", "PubmedBookArticle")
+
+# XPath expressions evaluated for every article, compiled once
+_PMID_XP = etree.XPath("string(.//PMID)")
+_TITLE_XP = etree.XPath("string(.//ArticleTitle)")
+_EMAIL_XP = etree.XPath("string(.//Email)")
+_AUTHOR_XP = etree.XPath(".//Author")
+
+
+def _is_company_affiliation(affiliation: str) -> bool:
+    """Check whether an affiliation mentions a pharmaceutical or biotech keyword."""
+    if not affiliation:  # Nothing to match, skip the search entirely
+        return False
+    if _AFFIL_AUTOMATON is not None:
+        # The automaton is case-sensitive, so the input is lowered once per affiliation
+        return next(_AFFIL_AUTOMATON.iter(affiliation.lower()), None) is not None
+    return _AFFIL_RE.search(affiliation) is not None  # IGNORECASE, no lowered copy
+
+
+def _format_value(value) -> str:
+    """Format a paper field for output, joining list fields with commas."""
+    return ", ".join(value) if isinstance(value, list) else value
+
+
+def _request_interval(api_key: Optional[str]) -> float:
+    """Return the minimum spacing between requests allowed for the given API key."""
+    return _REQUEST_INTERVAL_WITH_API_KEY if api_key else _REQUEST_INTERVAL
+
+
+def _wait_for_rate_limit(interval: float) -> None:
+    """Block until the next E-utilities request may start, spacing launches process-wide."""
+    global _next_request_at
+    with _request_lock:
+        now = time.monotonic()
+        wait = _next_request_at - now
+        _next_request_at = max(now, _next_request_at) + interval  # Reserve this launch slot
+    if wait > 0:
+        time.sleep(wait)
+
+
+class _PacedRetry(Retry):
+    """urllib3 Retry that also paces retried requests under NCBI's rate limit."""
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        # The session is shared by fetchers with and without an API key, so use the keyless interval
+        _wait_for_rate_limit(_REQUEST_INTERVAL)
+
+
+def _is_cacheable(response: requests.Response) -> bool:
+    """Keep efetch error bodies, which NCBI sends with status 200, out of the on-disk cache."""
+    if "efetch.fcgi" in response.url:
+        return b"<PubmedArticleSet" in response.content
+    return True
+
+
+@lru_cache(maxsize=None)
+def _create_session(use_cache: bool) -> requests.Session:
+    """Create the process-wide HTTP session that keeps connections alive and retries failed requests."""
+    if use_cache and requests_cache is not None:
+        session = requests_cache.CachedSession(
+            _CACHE_NAME,
+            backend="sqlite",
+            expire_after=_WEBENV_EXPIRE_AFTER,
+            filter_fn=_is_cacheable,
+        )
+        session.cache.delete(expired=True)  # Entries for old WebEnvs can never be hit again
+    else:
+        session = requests.Session()
+    session.headers.update({"User-Agent": "pubmed-fetcher"})
+    retries = _PacedRetry(
+        total=3,
+        backoff_factor=0.5,  # Exponential backoff: no sleep before the first retry, then 1s, 2s
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,  # urllib3's default, kept explicit: honour NCBI's Retry-After
+    )
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _esearch(url: str, params: Tuple[Tuple[str, object], ...], use_cache: bool,
+             refresh: bool = False) -> Tuple[int, str, str]:
+    """Run an esearch query and return its count, WebEnv and query_key, memoized for a short time."""
+    key = (url, params, use_cache)
+    with _esearch_memo_lock:
+        if refresh:  # The WebEnv turned out to be stale: drop it and bypass the on-disk cache too
+            _esearch_memo.pop(key, None)
+        elif key in _esearch_memo:
+            expires_at, result = _esearch_memo[key]
+            if time.monotonic() < expires_at:
+                _esearch_memo.move_to_end(key)
+                return result
+
+    _wait_for_rate_limit(_request_interval(dict(params).get("api_key")))
+    session = _create_session(use_cache)
+    if refresh and requests_cache is not None and isinstance(session, requests_cache.CachedSession):
+        response = session.get(url, params=dict(params), timeout=60, force_refresh=True)
+    else:
+        response = session.get(url, params=dict(params), timeout=60)
+    response.raise_for_status()  # Raise an error for bad status codes
+
+    # Parse JSON response
+    data = json_loads(response.content).get("esearchresult", {})
+    result = (int(data.get("count", 0)), data.get("webenv"), data.get("querykey"))
+    with _esearch_memo_lock:
+        _esearch_memo[key] = (time.monotonic() + _WEBENV_EXPIRE_AFTER, result)
+        _esearch_memo.move_to_end(key)
+        if len(_esearch_memo) > _ESEARCH_MEMO_SIZE:
+            _esearch_memo.popitem(last=False)
+    return result
+
 
 class PubMedFetcher:
     """A class to fetch and filter research papers from PubMed."""
@@ -10,116 +186,171 @@ class PubMedFetcher:
     BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
     FETCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
 
-    def __init__(self, query: str, debug: bool = False):
+    BATCH_SIZE = 500  # Papers requested per efetch call
+    MAX_WORKERS = 3  # Concurrent efetch calls; launches are paced separately by _wait_for_rate_limit
+    MAX_WORKERS_WITH_API_KEY = 10  # With an API key, launches may be spaced only 0.1s apart
+    CHUNK_SIZE = 64 * 1024  # Bytes fed to the XML parser at a time
+
+    def __init__(self, query: str, debug: bool = False, api_key: Optional[str] = None,
+                 max_results: int = 10, use_cache: bool = False):
         self.query = query
         self.debug = debug
+        self.api_key = api_key or os.environ.get("NCBI_API_KEY")
+        self.max_results = max_results
+        self.use_cache = use_cache
+        if use_cache and requests_cache is None and debug:
+            print("requests-cache is not installed; responses will not be cached.")
+        self.session = _create_session(use_cache)
 
     def fetch_papers(self) -> List[Dict]:
-        """Fetch 5 papers from PubMed based on the query."""
+        """Fetch up to max_results papers from PubMed based on the query."""
         search_params = {
             "db": "pubmed",
             "term": self.query,
             "retmode": "json",
-            "retmax": 10,  # Fetch 5 papers instead of 1
+            "retmax": 0,  # IDs stay on the history server; max_results caps the efetch paging
+            "usehistory": "y",  # Keep results on the history server for batched efetch
         }
+        if self.api_key:
+            search_params["api_key"] = self.api_key
         if self.debug:
-            print(f"Fetching 10 papers for query: {self.query}")
-
-        # Retry logic for API requests
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                response = requests.get(self.BASE_URL, params=search_params, timeout=60)
-                response.raise_for_status()  # Raise an error for bad status codes
+            print(f"Fetching up to {self.max_results} papers for query: {self.query}")
 
-                # Parse JSON response
-                data = response.json()
-                paper_ids = data.get("esearchresult", {}).get("idlist", [])
-                break  # Exit the retry loop if the request succeeds
-            except (requests.exceptions.RequestException, ValueError) as e:
-                #if self.debug:
-                  #  print(f"Attempt {attempt + 1} failed: {e}")
-                if attempt == max_retries - 1:
-                    if self.debug:
-                        print("Max retries reached. Failed to fetch papers.")
-                    return []
-                time.sleep(5)  # Wait 5 seconds before retrying
+        params = tuple(search_params.items())
+        try:
+            count, webenv, query_key = _esearch(self.BASE_URL, params, self.use_cache)
+            count = min(count, self.max_results)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            if self.debug:
+                print(f"Failed to fetch papers: {e}")
+            return []
 
         if self.debug:
-            print(f"Found {len(paper_ids)} papers.")
+            print(f"Found {count} papers.")
+        if not (count and webenv):
+            return []
 
-        papers = []
-        if paper_ids:  # Process the first 5 papers
-            for idx, paper_id in enumerate(paper_ids[:10]):  # Process up to 5 papers
+        pages = [(retstart, min(self.BATCH_SIZE, count - retstart))
+                 for retstart in range(0, count, self.BATCH_SIZE)]
+        results = self._fetch_batches(webenv, query_key, pages)
+
+        failed = [idx for idx, batch in enumerate(results) if batch is None]
+        if failed:
+            # A failed page may mean the memoized WebEnv expired on NCBI's side; search again and
+            # retry only those pages
+            if self.debug:
+                print(f"{len(failed)} batch(es) failed, re-running the search and retrying them.")
+            try:
+                _, webenv, query_key = _esearch(self.BASE_URL, params, self.use_cache, refresh=True)
+            except (requests.exceptions.RequestException, ValueError) as e:
                 if self.debug:
-                    print(f"Processing paper {idx + 1}/{len(paper_ids)}...")
-                paper_details = self._fetch_paper_details(paper_id)
-                if paper_details:
-                    papers.append(paper_details)
+                    print(f"Failed to re-run the search: {e}")
+            else:
+                retried = self._fetch_batches(webenv, query_key, [pages[idx] for idx in failed])
+                for idx, batch in zip(failed, retried):
+                    results[idx] = batch
 
-        return papers
+        return [paper for batch in results if batch for paper in batch]
 
-    def _fetch_paper_details(self, paper_id: str) -> Optional[Dict]:
-        """Fetch details for a single paper."""
+    def _fetch_batches(self, webenv: str, query_key: str,
+                       pages: List[Tuple[int, int]]) -> List[Optional[List[Dict]]]:
+        """Fetch the given (retstart, retmax) pages concurrently, with None for each failed page."""
+        if not pages:
+            return []
+        retstarts, retmaxes = zip(*pages)
+        max_workers = self.MAX_WORKERS_WITH_API_KEY if self.api_key else self.MAX_WORKERS
+        # Fetch pages concurrently on the shared session; map keeps them in order
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self._fetch_batch, repeat(webenv), repeat(query_key),
+                                     retstarts, retmaxes))
+
+    def _fetch_batch(self, webenv: str, query_key: str, retstart: int, retmax: int) -> Optional[List[Dict]]:
+        """Fetch one batch of papers from the history server, or None if the request failed."""
         fetch_params = {
             "db": "pubmed",
-            "id": paper_id,
+            "WebEnv": webenv,
+            "query_key": query_key,
+            "retstart": retstart,
+            "retmax": retmax,
             "retmode": "xml",
         }
-        # Retry logic for API requests
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                response = requests.get(self.FETCH_URL, params=fetch_params, timeout=60)
+        if self.api_key:
+            fetch_params["api_key"] = self.api_key
+        if self.debug:
+            print(f"Fetching papers {retstart + 1}-{retstart + retmax}...")
+        papers = []
+        try:
+            _wait_for_rate_limit(_request_interval(self.api_key))
+            response = self.session.get(self.FETCH_URL, params=fetch_params, timeout=60, stream=True)
+            with response:  # Release the pooled connection even when the status is an error
                 response.raise_for_status()  # Raise an error for bad status codes
 
-                break  # Exit the retry loop if the request succeeds
-            except requests.exceptions.RequestException as e:
-                if self.debug:
-                    print(f"Attempt {attempt + 1} failed: {e}")
-                if attempt == max_retries - 1:
+                # Parse XML response using lxml, one article at a time as it arrives
+                for idx, article in enumerate(self._iter_articles(response)):
                     if self.debug:
-                        print("Max retries reached. Failed to fetch paper details.")
-                    return None
-                time.sleep(5)  # Wait 5 seconds before retrying
+                        print(f"Processing paper {retstart + idx + 1}...")
+                    paper_details = self._parse_article(article)
+                    if paper_details:
+                        papers.append(paper_details)
+        except requests.exceptions.RequestException as e:
+            if self.debug:
+                print(f"Failed to fetch paper details: {e}")
+            return None
+        except (etree.XMLSyntaxError, ValueError) as e:
+            if self.debug:
+                print(f"Error parsing XML response: {e}")
+            return None
+        return papers
 
-        # Parse XML response using lxml
-        paper_xml = response.text
-        title = self._extract_from_xml(paper_xml, "ArticleTitle")
-        pub_date = self._extract_pub_date(paper_xml)  # Extract publication date
-        authors = self._extract_authors(paper_xml)
-        email = self._extract_from_xml(paper_xml, "Email")
+    def _iter_articles(self, response: requests.Response) -> Iterator[etree._Element]:
+        """Feed the streamed response to lxml and yield each article record once complete."""
+        # Pull parsers hold per-stream state, so each call (and worker thread) gets its own
+        parser = etree.XMLPullParser(events=("end",), tag=_ARTICLE_TAGS, **_PARSER_OPTIONS)
+        for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+            parser.feed(chunk)
+            for _, article in parser.read_events():
+                yield article
+                # Free memory held by the processed article and its preceding siblings
+                article.clear()
+                while article.getprevious() is not None:
+                    del article.getparent()[0]
+        root = parser.close()
+        # NCBI reports errors such as an expired WebEnv in an <eFetchResult> body with status 200
+        if root.tag != "PubmedArticleSet":
+            raise ValueError(f"Unexpected efetch response: <{root.tag}>")
 
-        # Filter authors with pharmaceutical or biotech affiliations
-        company_authors, company_affiliations = self._filter_authors(authors)
+    def _parse_article(self, article: etree._Element) -> Optional[Dict]:
+        """Extract details for a single paper from its PubmedArticle or PubmedBookArticle element."""
+        paper_id = self._extract_from_tree(article, _PMID_XP)
+        title = self._extract_from_tree(article, _TITLE_XP)
+        pub_date = self._extract_pub_date(article)  # Extract publication date
+        # Authors with pharmaceutical or biotech affiliations
+        company_authors, company_affiliations = self._extract_authors(article)
+        email = self._extract_from_tree(article, _EMAIL_XP)
 
         if company_authors:
             return {
                 "PubmedID": paper_id,
                 "Title": title,
                 "Publication Date": pub_date,
-                "Non-academic Author(s)": ", ".join(company_authors),
-                "Company Affiliation(s)": ", ".join(company_affiliations),
+                "Non-academic Author(s)": company_authors,  # Lists are joined only when written out
+                "Company Affiliation(s)": company_affiliations,
                 "Corresponding Author Email": email,
             }
         return None
 
-    def _extract_from_xml(self, xml: str, tag: str) -> str:
-        """Extract text from an XML tag using lxml."""
+    def _extract_from_tree(self, root: etree._Element, xpath: etree.XPath) -> str:
+        """Extract text from an XML tag using a precompiled string() XPath."""
         try:
-            root = etree.fromstring(xml.encode("utf-8"))
-            element = root.find(f".//{tag}")
-            if element is not None and element.text is not None:
-                return element.text.strip()
+            return xpath(root).strip()
         except Exception as e:
             if self.debug:
-                print(f"Error extracting {tag} from XML: {e}")
+                print(f"Error extracting {xpath.path} from XML: {e}")
         return ""
 
-    def _extract_pub_date(self, xml: str) -> str:
+    def _extract_pub_date(self, root: etree._Element) -> str:
         """Extract publication date from XML."""
         try:
-            root = etree.fromstring(xml.encode("utf-8"))
             pub_date = root.find(".//PubDate")
             if pub_date is not None:
                 year = pub_date.findtext("Year", "").strip()
@@ -131,46 +362,33 @@ class PubMedFetcher:
                 print(f"Error extracting publication date from XML: {e}")
         return ""
 
-    def _extract_authors(self, xml: str) -> List[Dict]:
-        """Extract authors and their affiliations from XML using lxml."""
-        authors = []
+    def _extract_authors(self, root: etree._Element) -> Tuple[List[str], List[str]]:
+        """Extract names and affiliations of authors with pharmaceutical or biotech affiliations."""
+        company_authors, company_affiliations = [], []
+        # All authors, only collected until the first company author is found
+        all_authors, all_affiliations = [], []
         try:
-            root = etree.fromstring(xml.encode("utf-8"))
-            for author in root.xpath("//Author"):
-                last_name = author.findtext("LastName", "").strip()
-                fore_name = author.findtext("ForeName", "").strip()
-                affiliation = author.findtext("Affiliation", "").strip()
-                if last_name:  # Only include authors with a last name
-                    authors.append({
-                        "name": f"{fore_name} {last_name}",
-                        "affiliation": affiliation
-                    })
+            for author in _AUTHOR_XP(root):
+                # Collect LastName/ForeName/Affiliation in one pass over the author's children
+                fields = {child.tag: (child.text or "").strip() for child in author}
+                last_name = fields.get("LastName")
+                if not last_name:  # Only include authors with a last name
+                    continue
+                name = f"{fields.get('ForeName', '')} {last_name}"
+                affiliation = fields.get("Affiliation", "")
+                if _is_company_affiliation(affiliation):
+                    company_authors.append(name)
+                    company_affiliations.append(affiliation)
+                elif not company_authors:
+                    all_authors.append(name)
+                    all_affiliations.append(affiliation)
         except Exception as e:
             if self.debug:
                 print(f"Error parsing XML for authors: {e}")
-        return authors
-
-    def _filter_authors(self, authors: List[Dict]) -> (List[str], List[str]):
-        """Filter authors with pharmaceutical or biotech affiliations."""
-        company_authors = []
-        company_affiliations = []
-        keywords = ["pharma", "biotech", "pharmaceutical", "biotechnology"]  # Keywords to filter affiliations
-
-        for author in authors:
-            affiliation = author.get("affiliation", "").lower()
-            if any(keyword in affiliation for keyword in keywords):
-                company_authors.append(author["name"])
-                company_affiliations.append(author["affiliation"])
 
         # If no company authors found, return all authors regardless of affiliation
         if not company_authors:
-            company_authors = [author["name"] for author in authors]
-            company_affiliations = [author["affiliation"] for author in authors]
-
-        #if self.debug:
-         #   print(f"Filtered authors: {company_authors}")
-          #  print(f"Filtered affiliations: {company_affiliations}")
-
+            return all_authors, all_affiliations
         return company_authors, company_affiliations
 
     def save_to_csv(self, papers: List[Dict], filename: str = None):
@@ -185,13 +403,14 @@ class PubMedFetcher:
         if filename:
             try:
                 with open(filename, "w", newline="", encoding="utf-8") as csvfile:
-                    writer = csv.DictWriter(csvfile, fieldnames=papers[0].keys())
-                    writer.writeheader()
-                    writer.writerows(papers)
+                    fields = list(papers[0].keys())
+                    writer = csv.writer(csvfile)
+                    writer.writerow(fields)
+                    writer.writerows([_format_value(paper[field]) for field in fields] for paper in papers)
                 if self.debug:
                     print(f"Results saved to {filename}.")
             except Exception as e:
                 print(f"Error saving to CSV: {e}")
         else:
             for paper in papers:
-                print(paper)
+                print({field: _format_value(value) for field, value in paper.items()})